@@ -2,6 +2,9 @@
 
 # Requires:
 #     Python 3.9+
+# Optional:
+#     lxml, for faster parsing of HTML pages
+#     orjson, for faster loading of JSON
 
 # Result data:
 #
@@ -22,6 +25,7 @@
 # {<arch>: {<archive>: {"rel_path": <rel-path>, <hash-algorithm>: <hash>}}}
 
 import argparse
+import functools
 import html.parser
 import os
 import os.path
@@ -32,9 +36,22 @@ import urllib.error
 import urllib.parse
 import xml.etree.ElementTree
 
+try:
+    import lxml.etree
+    import lxml.html
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
 import qti_util
 
 
+# qt<major>_<version>[_<subversion>], e.g. qt5_5152_wasm, qt6_620_armv7.
+VERSION_RE = re.compile(r"qt[0-9]+[_-][0-9]+"
+                        r"(?:[_-](?:x86_64|x86|armv7|arm64_v8a|wasm))?")
+ARCHIVE_OS_SUFFIX_RE = re.compile(r"-Windows|-Linux|-MacOS")
+
+
 def argparse_parse(argv):
     script_dir = os.path.dirname(__file__)
 
@@ -80,7 +97,7 @@ def argparse_parse(argv):
         type=float,
         help="In 'mirrors' and 'versions' modes,\n"
              "    async download options:\n"
-             "1. number of worker processes;\n"
+             "1. number of worker threads;\n"
              "2. delay in seconds between progress prints.\n"
              "Default: 5 5")
     parser.add_argument(
@@ -89,7 +106,7 @@ def argparse_parse(argv):
         default=[400, 10],
         type=int,
         help="In 'hashes' mode, async download options:\n"
-             "1. number of worker processes;\n"
+             "1. number of worker threads;\n"
              "2. delay in seconds between progress prints.\n"
              "Default: 400 10")
     parser.add_argument(
@@ -106,12 +123,15 @@ def argparse_parse(argv):
 
 
 # Retrieves relative URLs from 'href' of '<a>' elements.
+# Used when lxml is not available.
 class SubitemsListParser(html.parser.HTMLParser):
     def __init__(self):
         super().__init__()
         self.subitems = []
 
+    # The same hrefs repeat over many pages.
     @staticmethod
+    @functools.lru_cache(maxsize=8192)
     def subitem_from_URL(raw_URL):
         URL = urllib.parse.urlparse(raw_URL)
         if URL.scheme or URL.netloc:
@@ -131,7 +151,20 @@ class SubitemsListParser(html.parser.HTMLParser):
                     break
 
 
+# lxml refuses documents without elements, they have no links anyway.
+def _lxml_hrefs(html, xpath):
+    try:
+        return lxml.html.fromstring(html).xpath(xpath)
+    except lxml.etree.ParserError:
+        return []
+
+
 def URL_subitems(URL, req_opts):
+    if HAS_LXML:
+        html = qti_util.retrieve_URL(URL, "", req_opts)
+        hrefs = _lxml_hrefs(html, "//a/@href")
+        subitems = map(SubitemsListParser.subitem_from_URL, hrefs)
+        return [subitem for subitem in subitems if subitem]
     html = qti_util.retrieve_URL_str(URL, req_opts)
     parser = SubitemsListParser()
     parser.feed(html)
@@ -139,14 +172,36 @@ def URL_subitems(URL, req_opts):
 
 
 # Retrieves full URLs from 'href' of '<a>' elements with 'HTTP' content.
+# Used when lxml is not available.
 class MirrorListParser(html.parser.HTMLParser):
     def __init__(self):
         super().__init__()
         self.last_href = ""
         self.mirrors = []
 
+    # Mirror hrefs are plain 'http(s)://host/path',
+    # those are normalized without parsing the whole URL.
+    # The same hrefs repeat over many pages.
     @staticmethod
+    @functools.lru_cache(maxsize=8192)
     def full_URL_from_URL(raw_URL):
+        scheme, sep, rest = raw_URL.partition("://")
+        if (not sep
+                or scheme not in ["http", "https"]
+                or not raw_URL.isascii()
+                or not raw_URL.isprintable()
+                or any(char in rest for char in "?#;[] ")):
+            return MirrorListParser.full_URL_by_urlparse(raw_URL)
+        host, slash, path = rest.partition("/")
+        if not host:
+            return ""
+        norm_path = posixpath.normpath(slash + path) if slash else ""
+        if norm_path == "/":
+            norm_path = ""
+        return f"https://{host}{norm_path}"
+
+    @staticmethod
+    def full_URL_by_urlparse(raw_URL):
         URL = urllib.parse.urlparse(raw_URL)
         if URL.scheme and URL.netloc:
             URL = URL._replace(scheme="https")
@@ -177,6 +232,11 @@ class MirrorListParser(html.parser.HTMLParser):
 
 def get_possible_mirrors(qt_URL, req_opts):
     mirrorlist_URL = f"{qt_URL}/static/mirrorlist"
+    if HAS_LXML:
+        html = qti_util.retrieve_URL(mirrorlist_URL, "", req_opts)
+        hrefs = _lxml_hrefs(html, "//a[.='HTTP']/@href")
+        mirrors = map(MirrorListParser.full_URL_from_URL, hrefs)
+        return [qt_URL] + [mirror for mirror in mirrors if mirror]
     html = qti_util.retrieve_URL_str(mirrorlist_URL, req_opts)
     parser = MirrorListParser()
     parser.feed(html)
@@ -200,9 +260,9 @@ def get_mirrors(args):
         async_arg = (possible_mirror, args.req_opts)
         async_args.append(async_arg)
     print(f"\nChecking {len(possible_mirrors)} qt mirrors.")
-    mirrors_availability = qti_util.pool_apply(_check_mirror,
-                                               async_args,
-                                               args.async_opts)
+    mirrors_availability = qti_util.thread_apply(_check_mirror,
+                                                 async_args,
+                                                 args.async_opts)
     mirrors = list(zip(possible_mirrors, mirrors_availability))
     available_mirrors = []
     unavailable_mirrors = []
@@ -220,16 +280,8 @@ def get_mirrors(args):
 
 
 def real_versions(possible_versions):
-    expected_subversions = ["x86_64", "x86", "armv7", "arm64_v8a", "wasm"]
-    versions = []
-    for possible_version in possible_versions:
-        version_split = re.split(r"[_-]", possible_version, 2)
-        qt_str, ver_str, subver_str = qti_util.force_len(version_split, 3)
-        if (re.fullmatch(r"qt[0-9]+", qt_str)
-                and re.fullmatch(r"[0-9]+", ver_str)
-                and (not subver_str or subver_str in expected_subversions)):
-            versions.append(possible_version)
-    return versions
+    return [possible_version for possible_version in possible_versions
+            if VERSION_RE.fullmatch(possible_version)]
 
 
 def _get_OS_platform_versions(OS, platform, platform_URL, req_opts):
@@ -254,9 +306,9 @@ def get_versions(args):
             async_args.append(async_arg)
     print(f"\nFetching available versions from {len(async_args)} HTML pages\n"
           f"    from {sdk_URL}")
-    async_results = qti_util.pool_apply(_get_OS_platform_versions,
-                                        async_args,
-                                        args.async_opts)
+    async_results = qti_util.thread_apply(_get_OS_platform_versions,
+                                          async_args,
+                                          args.async_opts)
     for async_result in async_results:
         OS, platform, OS_platform_versions = async_result
         versions[OS][platform] = OS_platform_versions
@@ -277,20 +329,21 @@ def print_versions(args):
 
 
 def arch_from_pkg_name(pkg_name):
-    if "debug_info" in pkg_name:
-        return pkg_name[pkg_name.find("debug_info"):]
+    debug_info_pos = pkg_name.find("debug_info")
+    if debug_info_pos >= 0:
+        return pkg_name[debug_info_pos:]
     else:
-        return pkg_name.split(".")[-1]
+        return pkg_name.rpartition(".")[2]
 
 
 def shorten_archive_name(archive):
-    return re.split(r"-Windows|-Linux|-MacOS", archive)[0]
+    return ARCHIVE_OS_SUFFIX_RE.split(archive, 1)[0]
 
 
 def _get_archives_of_version(version_URL, req_opts):
     archives_of_version = {}
     updates_xml_URL = f"{version_URL}/Updates.xml"
-    updates_xml = qti_util.retrieve_URL_str(updates_xml_URL, req_opts)
+    updates_xml = qti_util.retrieve_URL(updates_xml_URL, "", req_opts)
     xml_tree = xml.etree.ElementTree.fromstring(updates_xml)
     for package_update in xml_tree.iter("PackageUpdate"):
         pkg_name_tag = package_update.find("Name")
@@ -326,9 +379,9 @@ def get_archives(sdk_URL, ver_paths, async_opts, req_opts):
           " by fetching and processing\n"
           f"    {len(async_args)} 'Updates.xml' files\n"
           f"    from {sdk_URL}")
-    archives_as_list = qti_util.pool_apply(_get_archives_of_version,
-                                           async_args,
-                                           async_opts)
+    archives_as_list = qti_util.thread_apply(_get_archives_of_version,
+                                             async_args,
+                                             async_opts)
     return dict(zip(ver_paths, archives_as_list))
 
 
@@ -354,7 +407,9 @@ def fill_archives_with_hashes(archives, sdk_URL, async_opts, req_opts):
                 async_args.append(async_arg)
     print(f"\nFetching {len(async_args)} hashes for available archives\n"
           f"    from {sdk_URL}")
-    async_results = qti_util.pool_apply(_fetch_hash, async_args, async_opts)
+    async_results = qti_util.thread_apply(_fetch_hash,
+                                          async_args,
+                                          async_opts)
     for async_result in async_results:
         ver_path, arch, archive_name, fetchedhash = async_result
         archives[ver_path][arch][archive_name][qti_util.HASH_ALG] = fetchedhash
@@ -3,18 +3,24 @@
 # Requires:
 #     Python 3.9+
 #     7z
+# Optional:
+#     orjson, for faster loading of JSON
 
 import argparse
 import contextlib
 import os
 import os.path
-import secrets
+import random
 import subprocess
 import sys
+import threading
 
 import qti_util
 
 
+verified_cache_lock = threading.Lock()
+
+
 def argparse_parse(argv):
     script_dir = os.path.dirname(__file__)
 
@@ -83,7 +89,7 @@ def argparse_parse(argv):
         default=[5, 10],
         type=float,
         help="In 'download' mode, async download options:\n"
-             "1. number of worker processes;\n"
+             "1. number of worker threads;\n"
              "2. delay in seconds between progress prints.\n"
              "Default: 5 10")
     parser.add_argument(
@@ -113,7 +119,7 @@ def print_archives(args):
         versions = [v.removesuffix(".json") for v in version_JSONs]
         qti_util.print_list(sorted(versions))
     else:
-        qti_util.print_list(sorted(qti_util.get_dirs(path)))
+        qti_util.print_list(qti_util.get_dirs(path, sort=True))
 
 
 def get_archive_filepath(archive_info, archives_dir):
@@ -121,25 +127,71 @@ def get_archive_filepath(archive_info, archives_dir):
     return os.path.join(archives_dir, archive_filename)
 
 
-def _download_archive(archive_info, ver_path, mirror_URL, out_dir, req_opts):
+def load_verified_cache(archives_dir):
+    try:
+        return qti_util.load_JSON(qti_util.verified_cache_path(archives_dir))
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def verified_entry(filepath, file_hash):
+    stat = os.stat(filepath)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        qti_util.HASH_ALG: file_hash,
+    }
+
+
+def is_verified(verified_cache, filepath, expected_hash):
+    cached_entry = verified_cache.get(os.path.basename(filepath))
+    if not cached_entry:
+        return False
+    try:
+        return cached_entry == verified_entry(filepath, expected_hash)
+    except FileNotFoundError:
+        return False
+
+
+def mark_verified(verified_cache, filepath, file_hash, archives_dir):
+    entry = verified_entry(filepath, file_hash)
+    with verified_cache_lock:
+        verified_cache[os.path.basename(filepath)] = entry
+        qti_util.dump_JSON(verified_cache,
+                           qti_util.verified_cache_path(archives_dir))
+
+
+def _download_archive(archive_info,
+                      ver_path,
+                      mirror_URL,
+                      out_dir,
+                      verified_cache,
+                      req_opts):
     archive_filepath = get_archive_filepath(archive_info, out_dir)
+    expected_hash = archive_info[qti_util.HASH_ALG]
+    # Skip hashing of the file unchanged since the last verification.
+    if is_verified(verified_cache, archive_filepath, expected_hash):
+        return
     try:
         computed_hash = qti_util.compute_hash(archive_filepath,
                                               qti_util.HASH_ALG)
     except FileNotFoundError:
         computed_hash = ""
-    if computed_hash and computed_hash == archive_info[qti_util.HASH_ALG]:
+    if computed_hash and computed_hash == expected_hash:
+        mark_verified(verified_cache, archive_filepath, computed_hash, out_dir)
         return
     archive_URL = (f"{mirror_URL}/online/qtsdkrepository"
                    f"/{ver_path}/{archive_info['rel_path']}")
-    qti_util.retrieve_URL(archive_URL, archive_filepath, req_opts)
-    computed_hash = qti_util.compute_hash(archive_filepath,
+    computed_hash = qti_util.retrieve_URL(archive_URL,
+                                          archive_filepath,
+                                          req_opts,
                                           qti_util.HASH_ALG)
-    if computed_hash and computed_hash == archive_info[qti_util.HASH_ALG]:
+    if computed_hash and computed_hash == expected_hash:
+        mark_verified(verified_cache, archive_filepath, computed_hash, out_dir)
         return
     raise qti_util.HashMismathError(
               "Hash mismatch of just downloaded file\n"
-              f"    expected {archive_info[qti_util.HASH_ALG]}\n"
+              f"    expected {expected_hash}\n"
               f"    computed {computed_hash}\n"
               f"    for file {archive_filepath}\n"
               f"    downloaded from {archive_URL}")
@@ -151,18 +203,25 @@ def download_archives(archives,
                       out_dir,
                       async_opts,
                       req_opts):
-    working_mirrors = mirrors
+    # Mirrors are tried in random order, each one at most once.
+    shuffled_mirrors = list(mirrors)
+    random.shuffle(shuffled_mirrors)
     os.makedirs(out_dir, exist_ok=True)
-    while working_mirrors:
+    verified_cache = load_verified_cache(out_dir)
+    for mirror_URL in shuffled_mirrors:
         async_args = []
-        mirror_URL = secrets.choice(working_mirrors)
         for archive_info in archives.values():
-            async_arg = (archive_info, ver_path, mirror_URL, out_dir, req_opts)
+            async_arg = (archive_info,
+                         ver_path,
+                         mirror_URL,
+                         out_dir,
+                         verified_cache,
+                         req_opts)
             async_args.append(async_arg)
         try:
             print(f"Downloading {len(async_args)} archives\n"
                   f"    from {mirror_URL}")
-            qti_util.pool_apply(_download_archive, async_args, async_opts)
+            qti_util.thread_apply(_download_archive, async_args, async_opts)
             return
         except qti_util.HashMismathError:
             raise
@@ -170,7 +229,6 @@ def download_archives(archives,
             print(f"{type(except_obj).__name__}: {except_obj}\n"
                   f"Failed to fetch an archive from {mirror_URL}\n"
                   "The mirror will no longer be used for this run.")
-            working_mirrors.remove(mirror_URL)
     sys.exit("All mirrors unreachable.")
 
 
@@ -179,17 +237,32 @@ def extract_7z(file, out_dir, exe_7z):
     subprocess.run(command_7z, stdout=subprocess.PIPE, check=True)
 
 
-def unpack_archives(archives, archives_dir, out_dir, exe_7z):
+def unpack_archives(archives, archives_dir, out_dir, exe_7z, print_delay_s):
     os.makedirs(out_dir, exist_ok=True)
+    async_args = []
     for archive_info in archives.values():
         archive_filepath = get_archive_filepath(archive_info, archives_dir)
-        extract_7z(archive_filepath, out_dir, exe_7z)
+        async_arg = (archive_filepath, out_dir, exe_7z)
+        async_args.append(async_arg)
+    print(f"Unpacking {len(async_args)} archives\n"
+          f"    to {out_dir}")
+    # Each thread waits for its own 7z process, one per core.
+    async_opts = [os.cpu_count() or 1, print_delay_s]
+    qti_util.thread_apply(extract_7z, async_args, async_opts)
 
 
 def remove_archives(archives, archives_dir):
+    verified_cache = load_verified_cache(archives_dir)
     for archive_info in archives.values():
         archive_filepath = get_archive_filepath(archive_info, archives_dir)
         os.remove(archive_filepath)
+        verified_cache.pop(os.path.basename(archive_filepath), None)
+    verified_cache_file = qti_util.verified_cache_path(archives_dir)
+    if verified_cache:
+        qti_util.dump_JSON(verified_cache, verified_cache_file)
+    else:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(verified_cache_file)
     with contextlib.suppress(OSError):
         os.rmdir(archives_dir)
 
@@ -219,7 +292,11 @@ def download_unpack_archives(args):
                       args.async_opts,
                       args.req_opts)
     if not args.skip_unpack:
-        unpack_archives(archives, args.archives_dir, args.out_dir, args.exe_7z)
+        unpack_archives(archives,
+                        args.archives_dir,
+                        args.out_dir,
+                        args.exe_7z,
+                        args.async_opts[1])
         if not args.keep_archives:
             remove_archives(archives, args.archives_dir)
 
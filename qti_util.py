@@ -1,28 +1,64 @@
 #! /usr/bin/env python3
 
+import concurrent.futures
+import contextlib
 import hashlib
+import http.client
+import itertools
 import json
-import multiprocessing.pool
 import os
-import shutil
-import signal
-import time
+import threading
+import urllib.error
+import urllib.parse
 import urllib.request
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 
 HASH_ALG = "sha256"
+MAX_REDIRECTS = 10
+# Enough for a host and the mirror it redirects to.
+MAX_THREAD_CONNECTIONS = 2
+
+# Keep-alive connections of the current thread, by (scheme, netloc),
+# from the least to the most recently used.
+_thread_local = threading.local()
+
+# Folders created by dump_JSON, checked before calling os.makedirs.
+# Creating a folder twice is harmless, so no lock is needed.
+_created_dirs = set()
+
+
+# Set by thread_apply when a task fails or on Ctrl-C,
+# so the running downloads stop early.
+_stop_tasks = threading.Event()
 
 
 class HashMismathError(Exception):
     pass
 
 
+class TasksStoppedError(Exception):
+    pass
+
+
+# Page cache hints for reading, where supported.
+def fadvise(file_obj, advice):
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(file_obj.fileno(), 0, 0, getattr(os, advice))
+
+
 # https://stackoverflow.com/a/44873382
 def compute_hash(file, hash_alg):
     hashlib_obj = hashlib.new(hash_alg)
-    bytes_obj = bytearray(128*1024)
+    bytes_obj = bytearray(1 << 20)
     memoryview_obj = memoryview(bytes_obj)
-    with open(file, 'rb', buffering=0) as file_obj:
+    with open(file, "rb", buffering=0) as file_obj:
+        fadvise(file_obj, "POSIX_FADV_SEQUENTIAL")
         while bytes_read_num := file_obj.readinto(memoryview_obj):
             hashlib_obj.update(memoryview_obj[:bytes_read_num])
     return hashlib_obj.hexdigest()
@@ -34,38 +70,38 @@ def print_list(iterable):
 
 
 def force_len(list_obj, length, pad=""):
-    true_els_list = list(filter(None, list_obj))
-    overpadded_list = true_els_list + [pad] * length
-    return overpadded_list[:length]
+    true_els = (el for el in list_obj if el)
+    padded_els = itertools.chain(true_els, itertools.repeat(pad))
+    return list(itertools.islice(padded_els, length))
 
 
-def get_dirs(path):
-    dirs = []
+def get_dirs(path, sort=False):
     with os.scandir(path) as it:
-        for entry in it:
-            if entry.is_dir():
-                dirs.append(entry.name)
-    return dirs
+        dirs = [entry.name for entry in it if entry.is_dir()]
+    return sorted(dirs) if sort else dirs
 
 
 def get_files(path):
-    files = []
     with os.scandir(path) as it:
-        for entry in it:
-            if entry.is_file():
-                files.append(entry.name)
-    return files
+        return [entry.name for entry in it if entry.is_file()]
+
+
+# Archives already verified by hash, by file name:
+# {<archive>: {"size": <size>, "mtime": <mtime-ns>, <hash-algorithm>: <hash>}}
+def verified_cache_path(archives_dir):
+    return os.path.join(archives_dir, ".verified.json")
 
 
 def load_JSON(filepath):
-    with open(filepath, "r") as file_obj:
-        return json.load(file_obj)
+    with open(filepath, "rb") as file_obj:
+        return json_loads(file_obj.read())
 
 
 def dump_JSON(data, out_file):
     out_dir = os.path.dirname(out_file)
-    if out_dir:
+    if out_dir and out_dir not in _created_dirs:
         os.makedirs(out_dir, exist_ok=True)
+        _created_dirs.add(out_dir)
     tmp_file = out_file + ".tmp"
     with open(tmp_file, "w") as tmp_file_obj:
         json.dump(data, tmp_file_obj)
@@ -76,54 +112,221 @@ def retrieve_URL_str(URL, opts):
     return retrieve_URL(URL, "", opts).decode(errors="replace")
 
 
-def retrieve_URL(URL, filepath, opts):
+def _thread_connections():
+    if not hasattr(_thread_local, "connections"):
+        _thread_local.connections = {}
+    return _thread_local.connections
+
+
+def _close_connection(key):
+    conn = _thread_connections().pop(key, None)
+    if conn:
+        conn.close()
+
+
+# Worker threads live for the whole run,
+# so only a few recently used connections are kept open.
+def _get_connection(split_URL, timeout_s):
+    key = (split_URL.scheme, split_URL.netloc)
+    connections = _thread_connections()
+    conn = connections.pop(key, None)
+    if conn is None:
+        if split_URL.scheme == "https":
+            conn_class = http.client.HTTPSConnection
+        else:
+            conn_class = http.client.HTTPConnection
+        conn = conn_class(split_URL.netloc, timeout=timeout_s)
+    connections[key] = conn
+    while len(connections) > MAX_THREAD_CONNECTIONS:
+        _close_connection(next(iter(connections)))
+    conn.timeout = timeout_s
+    return conn
+
+
+def _request(split_URL, timeout_s):
+    conn = _get_connection(split_URL, timeout_s)
+    path = urllib.parse.urlunsplit(
+        ("", "", split_URL.path or "/", split_URL.query, ""))
+    headers = {"User-Agent": f"Python-urllib/{urllib.request.__version__}"}
+    while True:
+        reused = conn.sock is not None
+        try:
+            conn.request("GET", path, headers=headers)
+            return conn.getresponse()
+        except ConnectionError:
+            conn.close()
+            # The server may drop an idle keep-alive connection,
+            # retry once on a fresh one.
+            if not reused:
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+
+def _use_proxy(split_URL):
+    proxies = urllib.request.getproxies()
+    return (split_URL.scheme in proxies
+            and not urllib.request.proxy_bypass(split_URL.hostname or ""))
+
+
+# Reuses a keep-alive connection per thread and host,
+# falls back to urllib when a proxy is configured.
+@contextlib.contextmanager
+def open_URL(URL, timeout_s):
+    origin_key = None
+    for _ in range(MAX_REDIRECTS + 1):
+        split_URL = urllib.parse.urlsplit(URL)
+        key = (split_URL.scheme, split_URL.netloc)
+        if (split_URL.scheme not in ["http", "https"]
+                or _use_proxy(split_URL)):
+            with urllib.request.urlopen(URL, timeout=timeout_s) as response:
+                yield response
+            return
+        response = _request(split_URL, timeout_s)
+        if response.status in [301, 302, 303, 307, 308]:
+            location = response.getheader("Location", "")
+            response.read()
+            if origin_key is None:
+                origin_key = key
+            elif key != origin_key:
+                # Hosts in the middle of a redirect chain
+                # are unlikely to be requested again.
+                _close_connection(key)
+            URL = urllib.parse.urljoin(URL, location)
+            continue
+        if response.status != 200:
+            response.read()
+            raise urllib.error.HTTPError(URL, response.status,
+                                         response.reason,
+                                         response.headers, None)
+        try:
+            yield response
+        finally:
+            if not response.isclosed():
+                # The body is not read to the end,
+                # the connection can't be reused.
+                response.close()
+                _close_connection(key)
+        return
+    raise urllib.error.HTTPError(URL, response.status,
+                                 "Too many redirects",
+                                 response.headers, None)
+
+
+# Hashes the data on its way to the file, so the file is not read back.
+def copy_to_file(src_obj, dst_obj, hash_alg):
+    hashlib_obj = hashlib.new(hash_alg) if hash_alg else None
+    bytes_obj = bytearray(1 << 20)
+    memoryview_obj = memoryview(bytes_obj)
+    while bytes_read_num := src_obj.readinto(memoryview_obj):
+        if _stop_tasks.is_set():
+            raise TasksStoppedError("Download stopped.")
+        chunk = memoryview_obj[:bytes_read_num]
+        dst_obj.write(chunk)
+        if hashlib_obj:
+            hashlib_obj.update(chunk)
+    return hashlib_obj.hexdigest() if hashlib_obj else ""
+
+
+# Returns the contents if 'filepath' is empty,
+# otherwise the hash of the saved file if 'hash_alg' is specified.
+def retrieve_URL(URL, filepath, opts, hash_alg=""):
     timeout_s, attempt_delay_s, attempts = opts
     attempts = int(attempts)
     for attempt in range(attempts):
         try:
             contents = ""
-            with urllib.request.urlopen(URL, timeout=timeout_s) as response:
+            with open_URL(URL, timeout_s) as response:
                 if filepath:
                     with open(filepath, "wb") as file_obj:
-                        shutil.copyfileobj(response, file_obj)
+                        contents = copy_to_file(response, file_obj, hash_alg)
                 else:
                     contents = response.read()
             return contents
         except Exception:
             if attempt + 1 == attempts:
                 raise
-            time.sleep(attempt_delay_s)
+            # Returns early, with True, when the tasks are being stopped.
+            if _stop_tasks.wait(attempt_delay_s):
+                raise
+
+
+# Counts finished tasks in the completion callbacks,
+# so the waiting thread only wakes up to print the progress.
+class TasksProgress:
+    def __init__(self, total_tasks):
+        self.total_tasks = total_tasks
+        self.ready_tasks = 0
+        self.exception = None
+        self.condition = threading.Condition()
+
+    def finished(self):
+        return (self.ready_tasks == self.total_tasks
+                or self.exception is not None)
+
+    def task_done(self, _result):
+        with self.condition:
+            self.ready_tasks += 1
+            if self.finished():
+                self.condition.notify_all()
+
+    def task_failed(self, exception):
+        with self.condition:
+            if self.exception is None:
+                self.exception = exception
+            self.condition.notify_all()
+
+    def future_done(self, future):
+        if future.cancelled():
+            return
+        exception = future.exception()
+        if exception is None:
+            self.task_done(future.result())
+        else:
+            self.task_failed(exception)
+
+    def wait(self, print_delay_s):
+        with self.condition:
+            while not self.condition.wait_for(self.finished, print_delay_s):
+                print(f"{self.ready_tasks}/{self.total_tasks} tasks done."
+                      f" {print_delay_s} seconds passed since the last print.")
+            if self.exception is not None:
+                raise self.exception
+        print(f"Completed all {self.total_tasks} tasks.")
+
+
+# Executors are kept for the whole run, by number of workers,
+# so their threads keep the keep-alive connections between calls.
+_executors = {}
 
 
-# https://noswap.com/blog/python-multiprocessing-keyboardinterrupt
-def init_worker():
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
+def get_executor(workers_num):
+    if workers_num not in _executors:
+        _executors[workers_num] = (
+            concurrent.futures.ThreadPoolExecutor(workers_num))
+    return _executors[workers_num]
 
 
-def pool_apply(_func, async_args, async_opts):
-    check_progress_interval = 0.25
+# All tasks are I/O bound, worker threads share keep-alive connections.
+# Ctrl-C is delivered to the main thread, no need to mask it in workers.
+def thread_apply(_func, async_args, async_opts):
     workers_num, print_delay_s = async_opts
     workers_num = int(workers_num)
-    async_results = []
-    with multiprocessing.Pool(workers_num, init_worker) as pool:
-        tasks = [pool.apply_async(_func, async_a) for async_a in async_args]
-        total_tasks = len(tasks)
-        ready_tasks = 0
-        no_print_s = 0
-        while ready_tasks < total_tasks:
-            time.sleep(check_progress_interval)
-            no_print_s += check_progress_interval
-            ready_tasks = 0
-            for task in tasks:
-                if task.ready():
-                    if not task.successful():
-                        # Reraise the exception.
-                        task.get()
-                    ready_tasks += 1
-            if no_print_s >= print_delay_s:
-                print(f"{ready_tasks}/{total_tasks} tasks done."
-                      f" {no_print_s} seconds passed since the last print.")
-                no_print_s = 0
-        async_results = [task.get() for task in tasks]
-        print(f"Completed all {total_tasks} tasks.")
-    return async_results
+    progress = TasksProgress(len(async_args))
+    executor = get_executor(workers_num)
+    tasks = [executor.submit(_func, *async_a) for async_a in async_args]
+    for task in tasks:
+        task.add_done_callback(progress.future_done)
+    try:
+        progress.wait(print_delay_s)
+    except BaseException:
+        # Don't start the queued tasks, stop the running ones
+        # and wait for them to exit.
+        for task in tasks:
+            task.cancel()
+        _stop_tasks.set()
+        concurrent.futures.wait(tasks)
+        _stop_tasks.clear()
+        raise
+    return [task.result() for task in tasks]